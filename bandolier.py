@@ -2,15 +2,20 @@ import asyncio
 import uvicorn
 import aiohttp
 import aiofiles
+import aiofiles.os
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import FileResponse
-from dataclasses import dataclass, asdict
-import json
-from os import path, rename
-import glob
-from multiprocessing import shared_memory, Lock
+from dataclasses import dataclass, field, asdict, replace
+import orjson
+import hashlib
+import time
+import os
+import fcntl
+import errno
+from os import path
 from contextlib import asynccontextmanager
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from typing import List
 
 
 # Need to split this up for now to calculate model names. A better solution would be to refresh automatic1111 and find the model name from the path using the api.
@@ -19,25 +24,43 @@ MODEL_DIR_PATH = "/home/daniel/code/stable-diffusion-webui/models/Stable-diffusi
 # directory within above path to store models 
 MODEL_DIR = "bandolier"
 
-pending = shared_memory.ShareableList([bytes(1000)] * 100)
-pending_lock = Lock()
+CIVITAI_API = "https://civitai.com"
+CIVITAI_MODEL_CARD_PATH = "/api/v1/model-versions/by-hash/{}"
 
-def release_shared_memory():
-    global pending
-    pending.shm.close()
-    pending.shm.unlink()
-    del pending
+# Max number of concurrent downloads per worker
+MAX_PENDING = 100
+
+WORKERS = max(2, (os.cpu_count() or 1) // 2)
+
+# Directory mtimes are coarse, a change this close to the scan may share the mtime with one we haven't seen yet
+RACY_MTIME_NS = 1_000_000_000
 
 @asynccontextmanager
 async def lifespan(app):
     #stuff before start
-    for x in range(len(pending)):
-        pending[x] = None
+    app.state.pending = set()
+    app.state.pending_lock = asyncio.Lock()
+    app.state.background_tasks = set()
+
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=8, ttl_dns_cache=300, keepalive_timeout=75)
+    app.state.http = aiohttp.ClientSession(connector=connector, headers={'Content-type': 'application/json'})
+    civitai_connector = aiohttp.TCPConnector(limit_per_host=8, ttl_dns_cache=300, keepalive_timeout=75)
+    app.state.civitai = aiohttp.ClientSession(base_url=CIVITAI_API, connector=civitai_connector, headers={'Content-type': 'application/json'})
+
+    await aiofiles.os.makedirs(path.join(MODEL_DIR_PATH, MODEL_DIR), exist_ok=True)
+    app.state.db = {}
+    app.state.db_by_hash = {}
+    app.state.db_mtime = None
+    app.state.db_lock = asyncio.Lock()
+    await get_db()
 
     yield
 
     # Stuff when closing app
-    release_shared_memory()
+    # Let A1111 refreshes finish before their session goes away
+    await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+    await app.state.civitai.close()
+    await app.state.http.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -52,32 +75,137 @@ class Model:
     file_id: int
     filename: str
     download_url: str
+    a1111_name: str = field(init=False)
 
-async def store_model(model, data):
-    async with aiofiles.open(path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}.modelcard"), "w") as f:
-        await f.write(json.dumps(asdict(model)))
+    def __post_init__(self):
+        self.a1111_name = a1111_calc_model_name(self.filename)
 
-    src = path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}.pending")
-    dst = path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}")
-    rename(src, dst)
+async def store_model(model):
+    payload = orjson.dumps(asdict(model))
+    await asyncio.to_thread(write_modelcard, path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}.modelcard"), payload)
+
+    async with app.state.db_lock:
+        app.state.db[model.alias] = model
+        app.state.db_by_hash.setdefault(model.model_hash.lower(), model)
+
+async def store_alias(model, alias):
+    # Extra modelcard pointing at an already downloaded file, named by alias digest since aliases aren't safe filenames
+    aliased = replace(model, alias=alias)
+    alias_key = hashlib.sha256(alias.encode()).hexdigest()[:16]
+    payload = orjson.dumps(asdict(aliased))
+    await asyncio.to_thread(write_modelcard, path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}.{alias_key}.modelcard"), payload)
+
+    async with app.state.db_lock:
+        app.state.db[alias] = aliased
+
+    return aliased
+
+def write_modelcard(card_path, payload):
+    # Other workers scan the dir at any time, never let them see a half written card
+    tmp_path = f"{card_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+
+    os.replace(tmp_path, card_path)
+
+async def get_db():
+    # Other workers store models too, rescan when the model dir has changed
+    mtime = (await aiofiles.os.stat(path.join(MODEL_DIR_PATH, MODEL_DIR))).st_mtime_ns
+    async with app.state.db_lock:
+        if mtime != app.state.db_mtime:
+            app.state.db = await asyncio.to_thread(load_models)
+            app.state.db_by_hash = {}
+            for m in app.state.db.values():
+                app.state.db_by_hash.setdefault(m.model_hash.lower(), m)
+            # Don't trust a racy mtime, rescan on the next call instead
+            app.state.db_mtime = mtime if time.time_ns() - mtime > RACY_MTIME_NS else None
 
+        return app.state.db
 
-async def fetch_model_card(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers={'Content-type': 'application/json'}) as response:
-            r_data = await response.text()
+async def fetch_model_card(session, model_hash):
+    async with session.get(CIVITAI_MODEL_CARD_PATH.format(model_hash)) as response:
+        if response.status == 404:
+            raise HTTPException(status_code=404, detail="No such model on civitai")
+
+        if not 200 <= response.status < 300:
+            raise HTTPException(status_code=502, detail=f"civitai returned {response.status}")
+
+        r_data = await response.read()
 
     return r_data
 
-async def download_model(model):
-    data = bytearray()
-    async with aiohttp.ClientSession() as session:
-        async with session.get(model.download_url) as response:
-            async with aiofiles.open(path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}.pending"), "wb") as f:
-                async for r_data in response.content.iter_chunked(10*1024*1024):
-                    await f.write(r_data)
+async def download_model(session, model):
+    # Bounded queue between socket and disk so a slow write doesn't stall the receive
+    queue = asyncio.Queue(maxsize=4)
+
+    async def receive(response):
+        async for r_data in response.content.iter_chunked(1024*1024):
+            await queue.put(r_data)
+        await queue.put(None)
+
+    async def write(f):
+        while (r_data := await queue.get()) is not None:
+            await f.write(r_data)
+
+    pending_path = path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}.pending")
+    dst = path.join(MODEL_DIR_PATH, MODEL_DIR, f"{model.filename}")
+    # Workers lock the pending file while downloading. The lock dies with the process so a .pending file left by a crash is just taken over.
+    async with aiofiles.open(pending_path, "wb", opener=open_no_truncate) as f:
+        if not lock_pending_file(f.fileno(), pending_path):
+            return False
+
+        try:
+            await f.truncate(0)
+            async with session.get(model.download_url) as response:
+                # Preallocate so the model ends up in contiguous extents. Only trust the exact Content-Length, civitai's sizeKB is rounded.
+                if response.content_length and hasattr(os, "posix_fallocate"):
+                    try:
+                        await asyncio.to_thread(os.posix_fallocate, f.fileno(), 0, response.content_length)
+                    except OSError as e:
+                        # Only skip preallocation when the filesystem doesn't support it, a full disk should fail now
+                        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                            raise
+
+                receiver = asyncio.ensure_future(receive(response))
+                writer = asyncio.ensure_future(write(f))
+                try:
+                    await asyncio.gather(receiver, writer)
+                finally:
+                    receiver.cancel()
+                    writer.cancel()
+                    await asyncio.gather(receiver, writer, return_exceptions=True)
+
+            # Rename while still holding the lock so no other worker can take over the finished file
+            await aiofiles.os.replace(pending_path, dst)
+        except BaseException:
+            await aiofiles.os.remove(pending_path)
+            raise
+
+    return True
+
+def open_no_truncate(file, flags):
+    return os.open(file, flags & ~os.O_TRUNC, 0o666)
+
+def lock_pending_file(fd, pending_path):
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
 
-    return data
+    # The previous lock holder may have renamed or removed the file we opened
+    try:
+        return os.fstat(fd).st_ino == os.stat(pending_path).st_ino
+    except FileNotFoundError:
+        return False
+
+async def refresh_a1111():
+    #TODO Move to a config file
+    api_server = "http://127.0.0.1:7860"
+    try:
+        async with app.state.http.post(api_server + '/sdapi/v1/refresh-checkpoints', data=b'') as response:
+            await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("Could not refresh A1111 checkpoints:", e)
 
 def a1111_calc_model_name(filename):
     model_path = path.join(MODEL_DIR, filename)
@@ -89,139 +217,183 @@ def a1111_calc_model_name(filename):
 
 @app.get("/list")
 async def list():
-    db = load_models()
-    return [(m.alias, a1111_calc_model_name(m.filename)) for m in db.values()]
+    db = await get_db()
+    return [(m.alias, m.a1111_name) for m in db.values()]
 
 
 @app.get("/pending")
 async def list():
-    with pending_lock:
-        return {"pending": [p for p in pending if p is not None]}
+    # Pending aliases are tracked per worker, so this only lists downloads started by the worker answering the request.
+    # Duplicate downloads across workers are still prevented by the lock on the .pending file.
+    async with app.state.pending_lock:
+        return {"pending": sorted(app.state.pending)}
+
+class ModelFileResponse(FileResponse):
+    # Starlette streams the file through Python in chunk_size reads, the 64 KiB default is far too small for multi GB checkpoints
+    chunk_size = 1024*1024
 
 @app.get("/model/{alias}")
 async def get_model(alias):
-    db = load_models()
+    db = await get_db()
     if alias not in db:
         raise HTTPException(status_code=404, detail="No such model")
 
-    return FileResponse(path.join(MODEL_DIR_PATH, MODEL_DIR, db[alias].filename))
-    
-#    async def iterfile():
-#        async with aiofiles.open(path.join(MODEL_DIR, db[alias].filename), "rb") as f:
-#            async for chunk in f.aiter_bytes():
-#                yield chunk
-#
-#    return StreamingResponse(iterfile(), media_type="application/octet-stream")
+    full_path = path.join(MODEL_DIR_PATH, MODEL_DIR, db[alias].filename)
+    try:
+        stat_result = await aiofiles.os.stat(full_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Model file missing")
+
+    return ModelFileResponse(full_path, media_type="application/octet-stream", filename=db[alias].filename, stat_result=stat_result)
 
 class DownloadModelItem(BaseModel):
     hash: str
     alias: str
 
+class CivitaiFile(BaseModel):
+    primary: bool = False
+    name: str
+    id: int
+    downloadUrl: str
+    pickleScanResult: str
+    virusScanResult: str
+
+class CivitaiModel(BaseModel):
+    name: str
+    type: str
+
+class CivitaiModelCard(BaseModel):
+    id: int
+    modelId: int
+    baseModel: str
+    model: CivitaiModel
+    files: List[CivitaiFile]
+
+def known_alias_status(alias):
+    # Call with pending_lock held. store_model adds to the db before the alias leaves pending, so it's always in one of them.
+    if alias in app.state.pending:
+        return {alias: "pending"}
+
+    if alias in app.state.db:
+        return {alias: "present", "model_info": app.state.db[alias]}
+
+    return None
+
 @app.post("/download/civitai/")
 async def download_civitai(dm: DownloadModelItem):
     alias = dm.alias
     model_hash  = dm.hash
 
-    # TODO - check if hash already in db
-    db = load_models()
+    # Repeat polls for a pending or known alias shouldn't touch the disk
+    async with app.state.pending_lock:
+        status = known_alias_status(alias)
+        if status is not None:
+            return status
 
-    if alias in db:
-        return {alias: "present", "model_info": db[alias]}
+    # Another worker may have stored it since we last looked
+    await get_db()
 
-    with pending_lock:
-        if alias in pending:
-            return {alias: "pending"}
+    async with app.state.pending_lock:
+        status = known_alias_status(alias)
+        if status is not None:
+            return status
 
-        idx = pending.index(None)
-        if idx == None:
+        existing = app.state.db_by_hash.get(model_hash.lower())
+        if existing is None and len(app.state.pending) >= MAX_PENDING:
             raise HTTPException(status_code=500, detail="Too many pending downloads")
 
-        pending[idx] = alias
-
-    resp = await fetch_model_card(f"https://civitai.com/api/v1/model-versions/by-hash/{model_hash}")
-    model_card = json.loads(resp)
-
-    if model_card["model"]["type"] != "Checkpoint":
-        with pending_lock:
-            idx = pending.index(alias)
-            pending[idx] = None
-        raise HTTPException(status_code=422, detail="Model was of wrong type")
-
-    if model_card["baseModel"] not in ["SD 1.5", "Other", "SD 1.4", "SDXL 1.0", "SDXL 0.9"]:
-        with pending_lock:
-            idx = pending.index(alias)
-            pending[idx] = None
-        print("Could not handle model type:", model_card["baseModel"])
-        raise HTTPException(status_code=422, detail="Base model type not implemented")
-    
-    name = model_card["model"]["name"]
-    model_id = model_card["modelId"]
-    version_id = model_card["id"]
-    
-    primary_file_obj = [f for f in model_card["files"] if f.get("primary") == True][0]
+        app.state.pending.add(alias)
+
+    if existing is not None:
+        try:
+            model = await store_alias(existing, alias)
+        finally:
+            async with app.state.pending_lock:
+                app.state.pending.discard(alias)
+
+        return {alias: "present", "model_info": model, "model_name": model.a1111_name}
+
+    try:
+        resp = await fetch_model_card(app.state.civitai, model_hash)
+        try:
+            model_card = CivitaiModelCard.model_validate_json(resp)
+        except ValidationError:
+            raise HTTPException(status_code=502, detail="Failed to parse model card")
+
+        if model_card.model.type != "Checkpoint":
+            raise HTTPException(status_code=422, detail="Model was of wrong type")
+
+        if model_card.baseModel not in ["SD 1.5", "Other", "SD 1.4", "SDXL 1.0", "SDXL 0.9"]:
+            print("Could not handle model type:", model_card.baseModel)
+            raise HTTPException(status_code=422, detail="Base model type not implemented")
+        
+        name = model_card.model.name
+        model_id = model_card.modelId
+        version_id = model_card.id
+        
+        primary_file_obj = next((f for f in model_card.files if f.primary), None)
+        if primary_file_obj is None:
+            raise HTTPException(status_code=422, detail="Model has no primary file")
 
 # Skip this since we check pickle and virus scan results below
 #    if primary_file_obj["metadata"]["format"] != "SafeTensor":
 #        raise HTTPException(status_code=422, detail="Model was not a safetensor")
 
-    if primary_file_obj["pickleScanResult"] != "Success":
-        with pending_lock:
-            idx = pending.index(alias)
-            pending[idx] = None
-        raise HTTPException(status_code=422, detail="Model has failed pickle scan")
-
-    if primary_file_obj["virusScanResult"] != "Success":
-        with pending_lock:
-            idx = pending.index(alias)
-            pending[idx] = None
-        raise HTTPException(status_code=422, detail="Model has failed virus scan")
+        if primary_file_obj.pickleScanResult != "Success":
+            raise HTTPException(status_code=422, detail="Model has failed pickle scan")
 
-    filename = primary_file_obj["name"]
-    file_id = primary_file_obj["id"]
-    file_size = primary_file_obj["sizeKB"]
-    download_url = primary_file_obj["downloadUrl"]
+        if primary_file_obj.virusScanResult != "Success":
+            raise HTTPException(status_code=422, detail="Model has failed virus scan")
 
-    try:
-        model = Model(alias, name, "civitai", model_hash, model_id, version_id, file_id, filename, download_url)
-    except:
-        #TODO - cleanup pending file
-        raise HTTPException(status_code=500, detail="Failed to download model")
+        filename = primary_file_obj.name
+        file_id = primary_file_obj.id
+        download_url = primary_file_obj.downloadUrl
 
-    data = await download_model(model)
+        try:
+            model = Model(alias, name, "civitai", model_hash, model_id, version_id, file_id, filename, download_url)
+        except:
+            #TODO - cleanup pending file
+            raise HTTPException(status_code=500, detail="Failed to download model")
 
-    await store_model(model, data)
+        if not await download_model(app.state.http, model):
+            # Another worker is downloading the same file
+            return {alias: "pending"}
 
-    with pending_lock:
-        idx = pending.index(alias)
-        pending[idx] = None
+        await store_model(model)
+    finally:
+        async with app.state.pending_lock:
+            app.state.pending.discard(alias)
 
-    async with aiohttp.ClientSession() as session:
-        #TODO Move to a config file
-        api_server = "http://127.0.0.1:7860"
-        async with session.post(api_server + '/sdapi/v1/refresh-checkpoints', data='', headers={'Content-type': 'application/json'}) as response:
-            r_data = await response.text()
+    # Don't hold up the client on A1111, keep a reference so the task isn't garbage collected
+    task = asyncio.create_task(refresh_a1111())
+    app.state.background_tasks.add(task)
+    task.add_done_callback(app.state.background_tasks.discard)
 
-    return {alias: "present", "model_info": model, "model_name": a1111_calc_model_name(model.filename)} 
+    return {alias: "present", "model_info": model, "model_name": model.a1111_name} 
 
 def load_models():
     db = {}
-    model_card_files = glob.glob(f"{MODEL_DIR_PATH}/{MODEL_DIR}/*.modelcard")
-    for mcf in model_card_files:
-        with open(mcf, "r") as f:
-            mcf_data = f.read()
-            model = json.loads(mcf_data)
-            model = Model(model["alias"], model["name"], model["service"], model["model_hash"], model["model_id"], model["version_id"], model["file_id"], model["filename"], model["download_url"])
+    with os.scandir(path.join(MODEL_DIR_PATH, MODEL_DIR)) as it:
+        for mcf in it:
+            if not mcf.name.endswith(".modelcard") or not mcf.is_file():
+                continue
+
+            try:
+                with open(mcf.path, "rb") as f:
+                    mcf_data = f.read()
+                    model = orjson.loads(mcf_data)
+                    model = Model(model["alias"], model["name"], model["service"], model["model_hash"], model["model_id"], model["version_id"], model["file_id"], model["filename"], model["download_url"])
+            except (OSError, orjson.JSONDecodeError, KeyError, TypeError) as e:
+                print("Skipping unreadable modelcard", mcf.name, e)
+                continue
+
             db[model.alias] = model
 
     return db
 
 
-async def main():
-    load_models()
-    config = uvicorn.Config("bandolier:app", host="192.168.1.142", port=5000, log_level="info")
-    server = uvicorn.Server(config)
-    await server.serve()
-    release_shared_memory()
+def main():
+    uvicorn.run("bandolier:app", host="192.168.1.142", port=5000, workers=WORKERS, loop="uvloop", http="httptools", log_level="info")
 
 if __name__=="__main__":
-    asyncio.run(main())
+    main()